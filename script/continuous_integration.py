@@ -2,50 +2,87 @@ import argparse
 import subprocess
 import sys 
 import os
+import atexit
+import tempfile
+import shlex
+import shutil
+import multiprocessing
+import concurrent.futures
 
 CALLING_PATH = os.getcwd()
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_PATH)
 CONTINUOUS_INTEGRATION_LOG = os.path.join(CALLING_PATH, 'continuous_integration_output.txt')
 
-# open and truncate file
-output = open(CONTINUOUS_INTEGRATION_LOG,'w');
+# open and truncate file once for the entire run, with a large write buffer
+output = open(CONTINUOUS_INTEGRATION_LOG,'wb',buffering=65536)
 
-def test_strings():
-    class test_strings_class:
-        def separator(self):
-            return '[----------] '
+# live console output, disabled by run_suite() when a compiler suite captures 
+# its output into its own log file
+console = sys.stdout.buffer
 
-        def run(self):
-            return '[ RUN      ] '
+# googletest style line prefixes, encoded once for the log buffer
+SEP = b'[----------] '
+RUN = b'[ RUN      ] '
+OK = b'[       OK ] '
+FAIL = b'[  FAILED  ] '
 
-        def ok(self):
-            return '[       OK ] '
+# log text is batched here and written out on size threshold, failure or 
+# before a child process is started
+_buf = bytearray()
+_BUF_MAX = 8192
 
-        def stderr(self):
-            return '[  STDERR  ] '
+def _flush():
+    if _buf:
+        if console is not None:
+            sys.stdout.flush()
+            console.write(_buf)
+            console.flush()
+        output.write(_buf)
+        _buf.clear()
 
-        def failed(self):
-            return '[  FAILED  ] ' 
-
-    return test_strings_class()
+atexit.register(_flush)
 
 def log(s):
-    global output 
     if isinstance(s, str):
-        sys.stdout.write(s)
-        sys.stdout.flush()
-        output.write(s)
-
-def execute(cmd, cwd=None):
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,cwd=cwd)
-
-    for line in process.stdout:
-        print(str(line, 'utf-8'), flush=True, end='')
-    
-    stdout, stderr = process.communicate()
-    
-    return process.returncode, stderr
+        s = s.encode()
+    if isinstance(s, bytes):
+        _buf.extend(s)
+        if len(_buf) >= _BUF_MAX or (s.endswith(b'\n') and b'FAILED' in s):
+            _flush()
+
+def execute(cmd, cwd=None, env=None, sink=None):
+    # The child writes straight to the sink capturing its output, or else to 
+    # the log file, so its output is never copied through python. Pending log 
+    # text is flushed first so it stays ordered with the child output.
+    if sink is None:
+        _flush()
+        output.flush()
+        sink = output
+    return subprocess.run(cmd, stdout=sink, stderr=subprocess.STDOUT,cwd=cwd,env=env).returncode
+
+def _append_file(f):
+    # The contents of f are copied to the console and log file by the kernel 
+    # where possible, without passing through python.
+    _flush()
+    size = os.fstat(f.fileno()).st_size
+    for dst in [ console, output ]:
+        if dst is None:
+            continue
+        dst.flush()
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError:
+            # sendfile() refuses some destinations, e.g. ones opened for 
+            # appending, copy the rest through python instead
+            f.seek(offset)
+            shutil.copyfileobj(f, dst)
+            dst.flush()
 
 # print functions are intended to blend in with googletest print output
 command_separator_newline_required = False 
@@ -55,134 +92,178 @@ def print_command_separator(string):
     if command_separator_newline_required == False:
         command_separator_newline_required = True 
     else:
-        log('\n')
-    log(test_strings().separator()+string+'\n')
+        log(b'\n')
+    log(SEP+string.encode()+b'\n')
 
 def print_command_prepend(string):
-    log(test_strings().run()+string+'\n')
+    log(RUN+string.encode()+b'\n')
 
-def print_command_result(code, string, err=''):
-    if code == 0:
-        log(test_strings().ok()+string+'\n')
-    else:
-        if err != '':
-            log(test_strings().separator()+'\n')
-            log(test_strings().stderr()+'\n')
-            log(err)
-        log(test_strings().failed()+string+'\n')
-        log('    ErrorCode: '+str(code)+'\n');
-
-def validate(string):
-    print_command_prepend(string)
-    code, err = execute(string.split())
+def print_command_result(code, string):
     if code == 0:
-        print_command_result(code, string)
-        return True 
+        log(OK+string.encode()+b'\n')
     else:
-        print_command_result(code, string, err)
-        return False 
-
-def validateCommands(commands):
-    success = True
+        log(FAIL+string.encode()+b'\n')
+        log(b'    ErrorCode: '+str(code).encode()+b'\n')
+
+def command_script(commands):
+    # The shell prints the googletest style lines around each command itself 
+    # and stops at the first failing command.
+    run, ok, fail = (shlex.quote(prefix.decode()) for prefix in [ RUN, OK, FAIL ])
+    lines = [ ]
     for com in commands:
-        if validate(com) != True:
-            success = False 
-            break
+        name = shlex.quote(com)
+        lines.append(f'printf "%s%s\\n" {run} {name}')
+        lines.append(com)
+        lines.append(f'rc=$?; if [ $rc -eq 0 ]; then printf "%s%s\\n" {ok} {name}; else printf "%s%s\\n    ErrorCode: %d\\n" {fail} {name} $rc; exit $rc; fi')
+    return '\n'.join(lines) + '\n'
+
+def validateCommands(commands, cwd=None, env=None):
+    # The commands are run by a single shell instead of starting a process for 
+    # each of them. Its output goes straight into the log file, the console 
+    # only sees it once run_suite() has finished and the suite logs are 
+    # combined.
+    if len(commands) == 0:
+        return True
+
+    code = execute(['bash', '-c', command_script(commands)], cwd=cwd, env=env)
+    output.flush()
+    return code == 0
+
+def validateCommandsParallel(commands, cwd=None, env=None, workers=None):
+    # For independent commands only. All of them are run at once, each with 
+    # its output captured, and they are logged in the given order. Unlike 
+    # validateCommands() every command is run even if an earlier one fails.
+    def run(com):
+        captured = tempfile.TemporaryFile()
+        return execute(com.split(), cwd=cwd, env=env, sink=captured), captured
+
+    _flush()
+    success = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for com, (code, captured) in zip(commands, executor.map(run, commands)):
+            print_command_prepend(com)
+            with captured:
+                _append_file(captured)
+            print_command_result(code, com)
+            if code != 0:
+                success = False
+            _flush()
+            output.flush()
     return success
 
-def buildAndExecuteTests():
-    success = True
-    os.chdir(PROJECT_ROOT)
-   
-    # erase previous logfile by opening with 'w' 
-    print("CONTINUOUS_INTEGRATION_LOG["+CONTINUOUS_INTEGRATION_LOG+"]")
-    output = open(CONTINUOUS_INTEGRATION_LOG,'w');
+# compilers validated by the integration test, each built in its own directory
+COMPILER_SUITES = [
+    ('/usr/bin/gcc', '/usr/bin/g++', os.path.join(PROJECT_ROOT, 'build-gcc')),
+    ('/usr/bin/clang', '/usr/bin/clang++', os.path.join(PROJECT_ROOT, 'build-clang')),
+]
+
+# Parallel build jobs per suite. The suites build at the same time, so the cores 
+# are split between them. MCE_BUILD_JOBS overrides this, e.g. in constrained 
+# containers.
+def build_jobs():
+    jobs = os.environ.get('MCE_BUILD_JOBS')
+    if jobs is None:
+        return max(1, (os.cpu_count() or 1) // len(COMPILER_SUITES))
+    if not jobs.strip().isdecimal() or int(jobs) < 1:
+        sys.exit(f'MCE_BUILD_JOBS must be a positive integer, got {jobs!r}')
+    return int(jobs)
+
+BUILD_JOBS = build_jobs()
+
+def configure_command(build_dir):
+    # Always configured, even though the build directory is kept between runs. 
+    # This is cheap for an up to date tree, and a failed configure leaves a 
+    # CMakeCache.txt behind which must not be mistaken for a usable build 
+    # directory.
+    return 'cmake -S ' + PROJECT_ROOT + ' -B ' + build_dir
+
+def build_command(build_dir, target):
+    return f'cmake --build {build_dir} --target {target} -j {BUILD_JOBS}'
+
+def list_examples(ex_path):
+    return sorted(e.path for e in os.scandir(ex_path) if e.is_file() and e.name.startswith('example_') and 'human_only' not in e.name)
+
+def build_and_test(cc, build_dir, env):
+    # Stops at the first failing step, so nothing is run against a failed 
+    # build. cmake only runs before the first build, nothing after it changes 
+    # the configure inputs.
+    print_command_separator('build and run unit test code ('+cc+')')
+
+    steps = [
+        [ configure_command(build_dir), build_command(build_dir, 'mce_ut'), './tst/mce_ut' ],
+        [ build_command(build_dir, 'mce_ut_minimal'), './tst/mce_ut_minimal' ],
+    ]
+
+    for step in steps:
+        if not validateCommands(step, cwd=build_dir, env=env):
+            return False
+
+    print_command_separator('build and run example code ('+cc+')')
+
+    if not validateCommands([ build_command(build_dir, 'mce_ex') ], cwd=build_dir, env=env):
+        return False
+
+    # run example code, the examples are independent of each other and share 
+    # the cores of this suite like the build does
+    examples = list_examples(os.path.join(build_dir, "ex"))
+    return validateCommandsParallel(examples, cwd=build_dir, env=env, workers=BUILD_JOBS)
+
+def run_suite(cc, cxx, build_dir):
+    global console, output
+
+    # Each suite runs in its own process, so everything it logs is captured in 
+    # a log file inside its build directory and combined by the caller once 
+    # all suites have finished.
+    os.makedirs(build_dir, exist_ok=True)
+    suite_log = os.path.join(build_dir, 'continuous_integration_output.txt')
+    console = None
+    output = open(suite_log,'wb',buffering=65536)
+
+    # set the compilers for this suite only, the environment of the calling 
+    # process is left untouched
+    env = dict(os.environ, CC=cc, CXX=cxx)
+
+    success = build_and_test(cc, build_dir, env)
+    _flush()
     output.close()
+    return success, suite_log
 
-    print_command_separator('build and run unit test code')
-
-    def verify_success(success):
-        if success == False:
-            log('Integration Validation FAILURE')
-            sys.exit(1)
-
-    # test gcc compiler
-    os.environ['CC'] = '/usr/bin/gcc'
-    os.environ['CXX'] = '/usr/bin/g++'
-    commands = [ 'cmake ' + PROJECT_ROOT, 'make mce_ut', './tst/mce_ut' ]
-    success = validateCommands(commands)
-    verify_success(success)
-
-    commands = [ 'cmake ' + PROJECT_ROOT, 'make mce_ut_minimal', './tst/mce_ut_minimal' ]
-    success = validateCommands(commands)
-    verify_success(success)
-
-    print_command_separator('build and run example code')
-    commands = [ 'make clean', 'make mce_ex' ]
-    success = validateCommands(commands)
-    verify_success(success)
-
-    if success == True:
-        examples = [ ]
-        ex_path = os.path.join(PROJECT_ROOT, "ex")
-        ex_files = os.listdir(ex_path)
-
-        for f in ex_files:
-            if 'example_' in f and 'human_only' not in f:
-                ex = os.path.join(ex_path,f)
-                examples.append(ex)
-
-        examples.sort()
-
-        # run example code 
-        commands = examples
-        success = validateCommands(commands)
-    verify_success(success)
-
-    # test clang compiler
-    os.environ['CC'] = '/usr/bin/clang'
-    os.environ['CXX'] = '/usr/bin/clang++'
-    commands = [ 'cmake ' + PROJECT_ROOT, 'make mce_ut', './tst/mce_ut' ]
-    success = validateCommands(commands)
-    verify_success(success)
-
-    commands = [ 'cmake ' + PROJECT_ROOT, 'make mce_ut_minimal', './tst/mce_ut_minimal' ]
-    success = validateCommands(commands)
-    verify_success(success)
-
-    print_command_separator('build and run example code')
-    commands = [ 'make clean', 'make mce_ex' ]
-    success = validateCommands(commands)
-    verify_success(success)
-
-    if success == True:
-        examples = [ ]
-        ex_path = os.path.join(PROJECT_ROOT, "ex")
-        ex_files = os.listdir(ex_path)
-
-        for f in ex_files:
-            if 'example_' in f and 'human_only' not in f:
-                ex = os.path.join(ex_path,f)
-                examples.append(ex)
+def buildAndExecuteTests():
+    print("CONTINUOUS_INTEGRATION_LOG["+CONTINUOUS_INTEGRATION_LOG+"]")
+    sys.stdout.flush()
 
-        examples.sort()
+    # Nothing may be left buffered when the suite processes are forked, or it 
+    # would be written a second time by the children. Forking (rather than 
+    # spawning) also keeps children from re-importing this module, which would 
+    # truncate the log file.
+    _flush()
+    output.flush()
 
-        # run example code 
-        commands = examples
-        success = validateCommands(commands)
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(COMPILER_SUITES), mp_context=ctx) as executor:
+        results = list(executor.map(run_suite, *zip(*COMPILER_SUITES)))
 
-    verify_success(success)
-        
-    os.chdir(CALLING_PATH)
+    # combine the suite logs in a fixed order
+    success = True
+    for i, (suite_success, suite_log) in enumerate(results):
+        if i > 0:
+            log(b'\n')
+        with open(suite_log,'rb') as f:
+            _append_file(f)
+        if suite_success != True:
+            success = False
 
     if success == True:
         log('Integration Validation Success')
+        _flush()
         sys.exit(0)
     else:
         log('Integration Validation FAILURE')
+        _flush()
         sys.exit(1)
 
     
 if __name__ == "__main__":
     buildAndExecuteTests()
+    _flush()
     output.close()
@@ -4,6 +4,14 @@ import os
 import sys
 import subprocess
 import argparse
+import fcntl
+import functools
+import hashlib
+import shutil
+import tempfile
+import http.client
+import urllib.error
+import urllib.request
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
 root_dir = os.path.realpath(os.path.join(script_dir,'..'))
@@ -18,10 +26,35 @@ def parse_args():
     parser.add_argument('--patch', required=True)
     parser.add_argument('--url', required=True)
     parser.add_argument('--built-file', required=True)
+    parser.add_argument('--sha256', default=None,
+        help='expected sha256 checksum of the downloaded tarball')
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+        help='directory caching built boost trees, an empty value disables the cache')
     return parser.parse_args()
 
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'),'.cache'))
+    return os.environ.get('MCE_BOOST_CACHE', os.path.join(cache_home,'mce-boost'))
+
+# boost libraries and variant built by b2, only the static release variant is 
+# linked by mce
+B2_BUILD_OPTIONS = [
+    '--with-context',
+    '--with-coroutine',
+    '--with-thread',
+    'variant=release',
+    'link=static',
+    'threading=multi',
+    'runtime-link=shared'
+]
+
+@functools.lru_cache(maxsize=None)
+def underscore_version(major,minor,patch):
+    return f'boost_{major}_{minor}_{patch}'
+
 def boost_underscore_version(args):
-    return f'boost_{args.major}_{args.minor}_{args.patch}'
+    # argparse.Namespace is not hashable, cache on the version values instead
+    return underscore_version(args.major,args.minor,args.patch)
 
 def boost_tarball(args):
     return f'{boost_underscore_version(args)}.tar.gz'
@@ -30,13 +63,10 @@ def boost_dir(args):
     return f'boost/{boost_underscore_version(args)}'
 
 def execute(cmd, cwd=None):
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,cwd=cwd)
-
-    for line in process.stdout:
-        print(str(line, 'utf-8'), flush=True, end='')
-    
-    _ = process.communicate()
-    
+    # The child writes straight to stdout, flush anything printed by this 
+    # script first so it stays ordered with the child output.
+    sys.stdout.flush()
+    process = subprocess.run(cmd, stdout=sys.stdout, stderr=subprocess.STDOUT, cwd=cwd)
     return True if process.returncode == 0 else False
 
 def verify_file(path):
@@ -45,71 +75,221 @@ def verify_file(path):
 def verify_dir(path):
     return os.path.exists(path) and os.path.isdir(path)
 
+# size of the chunks copied from the download to the tarball
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def download_boost(args):
-    return execute(['wget', args.url])
+    # The tarball is streamed into a .part file which only replaces the 
+    # tarball once it is complete, an interrupted download is continued on the 
+    # next run.
+    btarball = os.path.join(root_dir,boost_tarball(args))
+    part = f'{btarball}.part'
+    print(f'download:{args.url}')
+
+    offset = os.path.getsize(part) if verify_file(part) else 0
+    request = urllib.request.Request(args.url)
+    if offset > 0:
+        request.add_header('Range',f'bytes={offset}-')
+
+    try:
+        with urllib.request.urlopen(request,timeout=60) as response:
+            # the server sent the whole file instead of the requested range
+            if response.status != 206:
+                offset = 0
+
+            length = response.headers.get('Content-Length')
+
+            with open(part,'ab' if offset > 0 else 'wb') as f:
+                shutil.copyfileobj(response,f,length=DOWNLOAD_CHUNK_SIZE)
+                written = f.tell() - offset
+    except urllib.error.HTTPError as e:
+        # the partial download is already complete or no longer matches
+        if e.code == 416 and offset > 0:
+            os.remove(part)
+            return download_boost(args)
+        perror(f'download failed:{e}')
+        return False
+    except (urllib.error.URLError,http.client.HTTPException,OSError) as e:
+        perror(f'download failed:{e}')
+        return False
+
+    if length is not None and written != int(length):
+        perror(f'download incomplete, received {written} of {length} bytes')
+        return False
+
+    if args.sha256 is not None:
+        checksum = sha256_file(part)
+        if checksum != args.sha256.lower():
+            perror(f'sha256 mismatch, expected {args.sha256} got {checksum}')
+            os.remove(part)
+            return False
+
+    os.replace(part,btarball)
+    return True
 
 def extract_tarball(tarball,destination):
-    return execute(['tar','-xzvf',tarball,'-C',destination])
+    # extract quietly, decompressing on all cores when pigz is available
+    if shutil.which('pigz') is None:
+        return execute(['tar','-xzf',tarball,'-C',destination])
+    else:
+        return execute(['tar','--use-compress-program=pigz','-xf',tarball,'-C',destination])
 
 def touch_built(args):
     return execute(['touch',args.built_file])
 
-def main():
-    args = parse_args()
+def boost_cache_dir(args):
+    # built boost trees are cached per version, download url and build options
+    if not args.cache_dir:
+        return None
+
+    options = ' '.join(B2_BUILD_OPTIONS)
+    key = hashlib.sha256(f'{args.major}.{args.minor}.{args.patch}:{args.url}:{options}'.encode()).hexdigest()
+    return os.path.join(args.cache_dir,key)
+
+def link_cached_boost(args,cache,broot):
+    cached = os.path.join(cache,boost_underscore_version(args))
+
+    if not verify_file(os.path.join(cache,'built')) or not verify_dir(cached):
+        return False
+
+    # never replace a boost tree extracted into the project itself
+    if os.path.islink(broot):
+        os.remove(broot)
+    elif os.path.exists(broot):
+        return False
+
+    os.makedirs(os.path.dirname(broot),exist_ok=True)
+    os.symlink(cached,broot)
+    return True
+
+def store_cached_boost(args,cache,broot):
+    cached = os.path.join(cache,boost_underscore_version(args))
+    built = os.path.join(cache,'built')
+
+    # The cache is shared by every checkout of the user, while boost.lock only 
+    # covers this one. Storing is serialized with a lock inside the cache.
+    os.makedirs(cache,exist_ok=True)
+    lock = open(os.path.join(cache,'lock'),'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    with lock:
+        # another checkout stored the tree in the meantime
+        if verify_file(built) and verify_dir(cached):
+            return
+
+        # anything without the built marker is left by an interrupted store
+        for entry in os.scandir(cache):
+            if entry.name.startswith('store-') or entry.path == cached:
+                shutil.rmtree(entry.path)
+
+        # Move the built tree into a staging directory inside the cache and 
+        # rename it into place once complete, the marker is written last. The 
+        # tree is then linked back into place.
+        staging = tempfile.mkdtemp(prefix='store-',dir=cache)
+        staged = os.path.join(staging,boost_underscore_version(args))
+        shutil.move(broot,staged)
+        os.rename(staged,cached)
+        os.rmdir(staging)
+        os.symlink(cached,broot)
+        open(built,'w').close()
+
+def build_boost(args,broot):
+    # A link points into the cache entry of another download url or set of 
+    # build options, or into a cache which has since been removed or disabled. 
+    # Never build through it, a private tree is extracted instead.
+    if os.path.islink(broot):
+        os.remove(broot)
+
+    if not verify_dir(broot):
+        btarball = os.path.join(root_dir,boost_tarball(args))
+        print(f'boost tarball:${btarball}')
+
+        if not verify_file(btarball):
+            if not download_boost(args):
+                perror('cannot download boost')
+                sys.exit(1)
 
-    if not verify_file(os.path.join(root_dir,args.built_file)):
-        broot = os.path.join(root_dir,boost_dir(args))
-        print(f'boost root:{broot}')
+            if not verify_file(btarball):
+                perror('boost tarball missing')
+                sys.exit(1)
 
-        if not verify_dir(broot):
-            btarball = os.path.join(root_dir,boost_tarball(args))
-            print(f'boost tarball:${btarball}')
+        broot_root = os.path.join(root_dir,'boost')
 
-            if not verify_file(btarball):
-                if not download_boost(args):
-                    perror('cannot download boost')
-                    sys.exit(1)
+        if not execute(['mkdir','-p',broot_root]):
+            perror(f'cannot make directory {broot_root}')
+            sys.exit(1)
 
-                if not verify_file(btarball):
-                    perror('boost tarball missing')
-                    sys.exit(1)
+        if not extract_tarball(btarball,broot_root):
+            perror('cannot extract boost')
+            sys.exit(1)
 
-            broot_root = os.path.join(root_dir,'boost')
+        if not verify_dir(broot):
+            perror('boost directory missing')
+            sys.exit(1)
 
-            if not execute(['mkdir','-p',broot_root]):
-                perror(f'cannot make directory {broot_root}')
-                sys.exit(1)
+    b2 = os.path.join(broot,'b2')
+    print(f'b2:{b2}')
 
-            if not extract_tarball(btarball,broot_root):
-                perror('cannot extract boost')
-                sys.exit(1)
+    if not verify_file(b2):
+        bootstrap = os.path.join(broot,'bootstrap.sh')
+        print(f'bootstrap:{bootstrap}')
 
-            if not verify_dir(broot):
-                perror('boost directory missing')
-                sys.exit(1)
+        if not verify_file(bootstrap):
+            perror('boost bootstrap.sh missing')
+            sys.exit(1)
 
-        b2 = os.path.join(broot,'b2')
-        print(f'b2:{b2}')
+        if not execute([bootstrap],cwd=broot):
+            perror('could not bootstrap boost')
+            sys.exit(1)
 
         if not verify_file(b2):
-            bootstrap = os.path.join(broot,'bootstrap.sh')
-            print(f'bootstrap:{bootstrap}')
+            perror('b2 missing')
+            sys.exit(1)
 
-            if not verify_file(bootstrap):
-                perror('boost bootstrap.sh missing')
-                sys.exit(1)
+    # build on all cores and without printing every compiled object
+    if not execute([b2,f'-j{os.cpu_count() or 1}','-d0'] + B2_BUILD_OPTIONS,cwd=broot):
+        perror('could not build boost')
+        sys.exit(1)
 
-            if not execute([bootstrap],cwd=broot):
-                perror('could not bootstrap boost')
-                sys.exit(1)
+def is_built_fresh(args):
+    # an aborted or stale run leaves a built file older than the tarball
+    built_file = os.path.join(root_dir,args.built_file)
+    btarball = os.path.join(root_dir,boost_tarball(args))
 
-            if not verify_file(b2):
-                perror('b2 missing')
-                sys.exit(1)
+    if not verify_file(built_file):
+        return False
 
-        if not execute([b2,'--with-context','--with-coroutine','--with-thread'],cwd=broot):
-            perror('could not build boost')
-            sys.exit(1)
+    # the tree is gone, e.g. the cache it was linked to has been cleared
+    if not verify_dir(os.path.join(root_dir,boost_dir(args))):
+        return False
+
+    # no tarball is left to compare with when boost came from the cache
+    if not verify_file(btarball):
+        return True
+
+    return os.path.getmtime(built_file) >= os.path.getmtime(btarball)
+
+def setup_boost(args):
+    if not is_built_fresh(args):
+        broot = os.path.join(root_dir,boost_dir(args))
+        print(f'boost root:{broot}')
+
+        cache = boost_cache_dir(args)
+
+        if cache is not None and link_cached_boost(args,cache,broot):
+            print(f'boost cache:{cache}')
+        else:
+            build_boost(args,broot)
+
+            if cache is not None:
+                store_cached_boost(args,cache,broot)
 
         if not touch_built(args):
             perror(f'could not create {args.built_file}')
@@ -118,5 +298,16 @@ def main():
     print('boost built')
     sys.exit(0)
 
+def main():
+    args = parse_args()
+
+    # Every build directory shares the boost tree in the project root and may 
+    # be building at the same time, only one of them may set it up at once. 
+    # The lock is released when the process exits.
+    lock = open(os.path.join(root_dir,'boost.lock'),'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    setup_boost(args)
+
 if __name__ == '__main__':
     main()